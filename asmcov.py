@@ -2,30 +2,90 @@
 """measure coverage of Linux ELF binary using ptrace"""
 __license__ = 'SPDX-License-Identifier: CC0-1.0'
 import argparse
+import array
 import ctypes
-import dataclasses
 import hashlib
 import html
 import os
 import sqlite3
+import struct
 import subprocess
 import sys
+import typing
 import webbrowser
 
+# returned by asmcovtrace_run* when a signal interrupted the trace
+_ASMCOVTRACE_INTERRUPTED = -1
+
+# e_ident, e_type, e_machine, e_version, e_entry
+_ELF64_HEADER = struct.Struct('<16sHHIQ')
+
+_ELF_TYPES = {0: 'NONE', 1: 'REL', 2: 'EXEC', 3: 'DYN', 4: 'CORE'}
+
+_SQL_INSERT_PROGRAM = '''INSERT INTO program(hash) VALUES(?)
+ON CONFLICT(hash) DO NOTHING'''
+
+_SQL_SELECT_PROGRAM = '''SELECT program_id, start_address
+FROM program
+WHERE hash = ?'''
+
+_SQL_UPDATE_START_ADDRESS = '''UPDATE program SET start_address = ?
+WHERE program_id = ?'''
+
+_SQL_HAS_LINES = '''SELECT EXISTS(
+    SELECT 1 FROM line WHERE program_id = ?
+)'''
+
+_SQL_INSERT_LINE = '''INSERT INTO line(
+    program_id, type, line_number, code, hits
+) VALUES(?, ?, ?, ?, ?)'''
+
+_SQL_SELECT_LINES = '''SELECT type, line_number, code, hits
+FROM line WHERE program_id = ?
+ORDER BY line_number ASC, type DESC'''
+
+_SQL_SELECT_INSTRUCTIONS = '''SELECT line_number
+FROM line
+WHERE program_id = ?
+AND type = "instruction"
+ORDER BY line_number ASC'''
+
+_SQL_SELECT_UNCOVERED = '''SELECT line_number
+FROM line
+WHERE program_id = ?
+AND type = "instruction"
+AND hits = 0
+ORDER BY line_number ASC'''
+
+_SQL_UPDATE_HITS = '''UPDATE line SET hits = hits + ?
+WHERE program_id = ?
+AND type = "instruction"
+AND line_number = ?'''
+
 
 class _Ptrace:
     def __init__(self):
         path = os.path.dirname(os.path.realpath(__file__)) + '/asmcovtrace.so'
         self._asmcovtrace = ctypes.cdll.LoadLibrary(path)
-        self._asmcovtrace.asmcovtrace_open.argtype = [
-            ctypes.POINTER(ctypes.c_char),
+        self._asmcovtrace.asmcovtrace_open.argtypes = [
+            ctypes.c_char_p,
             ctypes.POINTER(ctypes.c_char_p)
         ]
         self._asmcovtrace.asmcovtrace_open.restype = ctypes.c_int
-        self._asmcovtrace.asmcovtrace_next.argtype = [
-            ctypes.c_int
+        self._asmcovtrace.asmcovtrace_run.argtypes = [
+            ctypes.c_int,
+            ctypes.POINTER(ctypes.c_ulonglong),
+            ctypes.POINTER(ctypes.c_ulonglong),
+            ctypes.c_size_t
         ]
-        self._asmcovtrace.asmcovtrace_next.restype = ctypes.c_ulonglong
+        self._asmcovtrace.asmcovtrace_run.restype = ctypes.c_int
+        self._asmcovtrace.asmcovtrace_run_breakpoints.argtypes = [
+            ctypes.c_int,
+            ctypes.POINTER(ctypes.c_ulonglong),
+            ctypes.POINTER(ctypes.c_ulonglong),
+            ctypes.c_size_t
+        ]
+        self._asmcovtrace.asmcovtrace_run_breakpoints.restype = ctypes.c_int
 
     def asmcovtrace_open(self, path, argv):
         """call asmcovtrace_open in asmcovtrace.so"""
@@ -34,13 +94,30 @@ class _Ptrace:
         argv = (ctypes.c_char_p * len(argv))(*argv)
         return self._asmcovtrace.asmcovtrace_open(path, argv)
 
-    def asmcovtrace_next(self, pid):
-        """call asmcovtrace_next in asmcovtrace.so"""
-        return self._asmcovtrace.asmcovtrace_next(pid)
+    def asmcovtrace_run(self, pid, addrs, counts):
+        """call asmcovtrace_run in asmcovtrace.so"""
+        return self._asmcovtrace.asmcovtrace_run(
+            pid,
+            self._ulonglong_array(addrs),
+            self._ulonglong_array(counts),
+            len(addrs)
+        )
+
+    def asmcovtrace_run_breakpoints(self, pid, addrs, counts):
+        """call asmcovtrace_run_breakpoints in asmcovtrace.so"""
+        return self._asmcovtrace.asmcovtrace_run_breakpoints(
+            pid,
+            self._ulonglong_array(addrs),
+            self._ulonglong_array(counts),
+            len(addrs)
+        )
+
+    @staticmethod
+    def _ulonglong_array(values):
+        return (ctypes.c_ulonglong * len(values)).from_buffer(values)
 
 
-@dataclasses.dataclass
-class _AsmLine:
+class _AsmLine(typing.NamedTuple):
     type_: str
     line_number: int
     code: str
@@ -50,7 +127,6 @@ class _AsmLine:
 class _AsmCovReportHTML:
     def __init__(self, path):
         self._path = path
-        self._html = ''
 
     def generate(self, asm):
         """generate the HTML report and save to file"""
@@ -58,46 +134,55 @@ class _AsmCovReportHTML:
         path_css = f'{path_prism}/prism.css'
         path_js = f'{path_prism}/prism.js'
         data_lines = []
-        asm_html_lines = ''
+        asm_html_lines = []
+        append = asm_html_lines.append
+        escape = html.escape
         prev_asmline = None
         for idx, asmline in enumerate(asm):
             if asmline.type_ == 'instruction' and asmline.hits < 1:
                 if prev_asmline and prev_asmline.type_ == 'label':
-                    data_lines.append(str(idx))
-                data_lines.append(str(idx + 1))
+                    first_line = idx
+                else:
+                    first_line = idx + 1
+                if data_lines and data_lines[-1][1] + 1 >= first_line:
+                    data_lines[-1][1] = idx + 1
+                else:
+                    data_lines.append([first_line, idx + 1])
             if asmline.type_ == 'label':
-                asmline.code = asmline.code[1:-1] + ':'
+                code = asmline.code[1:-1] + ':'
             else:
-                asmline.code = '\t' + asmline.code
-                asmline.code += f' ; hits={str(asmline.hits)}'
-            asm_html_lines += html.escape(asmline.code) + '\n'
+                code = f'\t{asmline.code} ; hits={asmline.hits}'
+            append(escape(code))
+            append('\n')
             prev_asmline = asmline
-        data_lines = ','.join(data_lines)
-        self._html = '<!DOCTYPE html>\n'
-        self._html += '<html lang="en">'
-        self._html += '<head>'
-        self._html += '<meta charset="utf-8">'
-        self._html += '<title>asmcov</title>'
-        self._html += f'<link href="{path_css}" rel="stylesheet"/>'
-        self._html += '</head>'
-        self._html += '<body class="line-highlight">'
-        self._html += f'<script src="{path_js}"></script>'
-        self._html += '<header>'
-        self._html += '<h1>Assembly code coverage generated by asmcov</h1>'
-        self._html += '</header>'
-        self._html += '<div>'
-        self._html += f'<pre class="line-numbers" data-line="{data_lines}">'
-        self._html += '<code class="language-nasm">'
-        self._html += asm_html_lines
-        self._html += '</code>'
-        self._html += '</pre>'
-        self._html += '</div>'
-        self._html += '<footer>'
-        self._html += '</footer>'
-        self._html += '</body>'
-        self._html += '</html>'
+        data_lines = ','.join(
+            str(first) if first == last else f'{first}-{last}'
+            for first, last in data_lines
+        )
         with open(self._path, 'w') as file:
-            file.write(self._html)
+            file.write('<!DOCTYPE html>\n')
+            file.write('<html lang="en">')
+            file.write('<head>')
+            file.write('<meta charset="utf-8">')
+            file.write('<title>asmcov</title>')
+            file.write(f'<link href="{path_css}" rel="stylesheet"/>')
+            file.write('</head>')
+            file.write('<body class="line-highlight">')
+            file.write(f'<script src="{path_js}"></script>')
+            file.write('<header>')
+            file.write('<h1>Assembly code coverage generated by asmcov</h1>')
+            file.write('</header>')
+            file.write('<div>')
+            file.write(f'<pre class="line-numbers" data-line="{data_lines}">')
+            file.write('<code class="language-nasm">')
+            file.writelines(asm_html_lines)
+            file.write('</code>')
+            file.write('</pre>')
+            file.write('</div>')
+            file.write('<footer>')
+            file.write('</footer>')
+            file.write('</body>')
+            file.write('</html>')
 
     def display(self):
         """display the HTML report in the default web browser"""
@@ -112,7 +197,6 @@ class _AsmCov:
         self._args = args
         self._argv = argv
         self._ptrace = _Ptrace()
-        self._asm = []
         self._db = None
         self._program = {}
         self._load_db()
@@ -124,89 +208,120 @@ class _AsmCov:
         """run the binary and record coverage info"""
         self._get_hash()
         self._get_start_address()
-        if self._already_disassembled():
-            self._get_disassembly_db()
-        else:
+        if not self._already_disassembled():
             self._get_disassembly_file()
-            self._get_disassembly_db()
         self._trace_for_coverage()
 
     def gen_report(self):
         """generate a report showing line coverage"""
         self._get_hash()
         self._get_start_address()
-        self._get_disassembly_db()
         report = _AsmCovReportHTML('asmcov.html')
-        report.generate(self._asm)
+        report.generate(self._get_disassembly_db())
         report.display()
 
     def _load_db(self):
-        self._db = sqlite3.connect('asmcov.db')
+        self._db = sqlite3.connect(
+            'asmcov.db',
+            cached_statements=512,
+            isolation_level=None
+        )
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        self._db.execute('PRAGMA temp_store=MEMORY')
         self._db.execute(
             '''
             CREATE TABLE IF NOT EXISTS program(
-                program_id INTEGER PRIMARY KEY,
-                hash       TEXT UNIQUE
+                program_id    INTEGER PRIMARY KEY,
+                hash          TEXT UNIQUE,
+                start_address INTEGER
             )
             '''
         )
+        columns = [
+            column[1]
+            for column in self._db.execute('PRAGMA table_info(program)')
+        ]
+        if 'start_address' not in columns:
+            self._db.execute(
+                'ALTER TABLE program ADD COLUMN start_address INTEGER'
+            )
+        columns = [
+            column[1]
+            for column in self._db.execute('PRAGMA table_info(line)')
+        ]
+        migrate = 'line_id' in columns
+        if migrate:
+            self._db.execute('BEGIN IMMEDIATE')
+            self._db.execute('ALTER TABLE line RENAME TO line_old')
         self._db.execute(
             '''
             CREATE TABLE IF NOT EXISTS line(
-                line_id     INTEGER PRIMARY KEY,
                 program_id  INTEGER,
                 type        TEXT,
                 line_number INTEGER,
                 code        TEXT,
                 hits        INTEGER,
                 FOREIGN KEY(program_id) REFERENCES program(program_id),
-                UNIQUE(program_id, type, line_number)
-            )
+                PRIMARY KEY(program_id, line_number, type DESC)
+            ) WITHOUT ROWID
             '''
         )
+        if migrate:
+            self._db.execute(
+                '''
+                INSERT INTO line(program_id, type, line_number, code, hits)
+                SELECT program_id, type, line_number, code, hits
+                FROM line_old
+                '''
+            )
+            self._db.execute('DROP TABLE line_old')
+            self._db.execute('COMMIT')
 
     def _get_hash(self):
         with open(self._args.file, 'rb') as file:
-            file_data = file.read()
-        self._program['hash'] = hashlib.sha256(file_data).hexdigest()
-        cursor = self._db.cursor()
-        cursor.execute(
-            'INSERT INTO program(hash) VALUES(?) ON CONFLICT(hash) DO NOTHING',
-            (self._program['hash'],)
-        )
-        self._db.commit()
-        self._program['id'] = self._db.execute(
-            'SELECT program_id FROM program WHERE hash = ?',
+            if hasattr(hashlib, 'file_digest'):
+                digest = hashlib.file_digest(file, 'sha256')
+            else:
+                digest = hashlib.sha256()
+                for chunk in iter(lambda: file.read(1 << 20), b''):
+                    digest.update(chunk)
+        self._program['hash'] = digest.hexdigest()
+        self._db.execute(_SQL_INSERT_PROGRAM, (self._program['hash'],))
+        program = self._db.execute(
+            _SQL_SELECT_PROGRAM,
             (self._program['hash'],)
-        ).fetchone()[0]
+        ).fetchone()
+        self._program['id'] = program[0]
+        self._program['start_address'] = program[1]
 
     def _already_disassembled(self):
-        num_lines = self._db.execute(
-            '''SELECT COUNT(*)
-            FROM line
-            WHERE program_id = ?''',
+        has_lines = self._db.execute(
+            _SQL_HAS_LINES,
             (self._program['id'],)
         ).fetchone()[0]
-        if num_lines > 0:
+        if has_lines:
             return True
         return False
 
     def _get_start_address(self):
-        cmd = ['readelf', '-h', self._args.file]
-        result = subprocess.run(
-            cmd,
-            capture_output=True,
-            check=True,
-            text=True
+        if self._program['start_address'] is not None:
+            return
+        with open(self._args.file, 'rb') as file:
+            header = file.read(_ELF64_HEADER.size)
+        if len(header) < _ELF64_HEADER.size or header[:4] != b'\x7fELF':
+            sys.exit('ERROR: not an ELF file')
+        ident, type_, _, _, start_address = _ELF64_HEADER.unpack(header)
+        if ident[4] != 2 or ident[5] != 1:
+            sys.exit('ERROR: unsupported class: must be little-endian ELF64')
+        if type_ != 2:
+            type_ = _ELF_TYPES.get(type_, str(type_))
+            sys.exit(f'ERROR: unsupported type: {type_}')
+        self._program['start_address'] = start_address
+        self._db.execute(
+            _SQL_UPDATE_START_ADDRESS,
+            (self._program['start_address'], self._program['id'])
         )
-        for line in result.stdout.split('\n'):
-            if 'Entry point address:' in line:
-                start_address = line.partition(':')[2].strip()
-            elif 'Type:' in line:
-                type_ = line.partition(':')[2].strip()
-                if not type_.startswith('EXEC'):
-                    sys.exit(f'ERROR: unsupported type: {type_}')
-        self._program['start_address'] = int(start_address, 16)
 
     def _get_disassembly_file(self):
         cmd = [
@@ -216,27 +331,45 @@ class _AsmCov:
             '--start-address', str(self._program['start_address']),
             self._args.file
         ]
-        result = subprocess.run(
-            cmd,
-            capture_output=True,
-            check=True,
-            text=True
-        )
-        for line in result.stdout.split('\n'):
-            if not line:
-                continue
-            if 'Disassembly of section .text' in line:
-                continue
+        program_id = self._program['id']
+        self._db.execute('BEGIN IMMEDIATE')
+        try:
+            with subprocess.Popen(
+                cmd,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.DEVNULL,
+                text=True
+            ) as proc:
+                self._db.executemany(
+                    _SQL_INSERT_LINE,
+                    (
+                        (program_id, type_, line_number, code, 0)
+                        for type_, line_number, code
+                        in self._parse_disassembly(proc.stdout)
+                    )
+                )
+            if proc.returncode != 0:
+                raise subprocess.CalledProcessError(proc.returncode, cmd)
+        except BaseException:
+            if self._db.in_transaction:
+                self._db.execute('ROLLBACK')
+            raise
+        self._db.execute('COMMIT')
+
+    @staticmethod
+    def _parse_disassembly(lines):
+        for line in lines:
+            line = line.rstrip('\n')
             if line.endswith(':'):
+                if line.startswith('Disassembly of section .text'):
+                    continue
                 type_ = 'label'
-                label_split = line.partition(' ')
-                line_number = label_split[0]
-                code = label_split[2].rstrip(':')
+                line_number, _, code = line.partition(' ')
+                code = code.rstrip(':')
             else:
                 type_ = 'instruction'
-                line_split = line.partition(':')
-                line_number = line_split[0].lstrip()
-                tab_split = line_split[2].split('\t')
+                line_number, _, code = line.partition(':')
+                tab_split = code.split('\t', 3)
                 if len(tab_split) < 3:
                     continue
                 code = tab_split[2]
@@ -244,42 +377,57 @@ class _AsmCov:
                 line_number = int(line_number, 16)
             except ValueError:
                 continue
-            self._db.execute(
-                '''INSERT INTO line(program_id, type, line_number, code, hits)
-                VALUES(?, ?, ?, ?, ?)''',
-                (self._program['id'], type_, line_number, code, 0)
-            )
-        self._db.commit()
+            yield type_, line_number, code
 
     def _get_disassembly_db(self):
         asmlines = self._db.execute(
-            '''SELECT type, line_number, code, hits
-            FROM line WHERE program_id = ?
-            ORDER BY line_number ASC, type DESC''',
+            _SQL_SELECT_LINES,
             (self._program['id'],)
-        ).fetchall()
-        for asmline in asmlines:
-            asmline = _AsmLine(*asmline)
-            self._asm.append(asmline)
+        )
+        yield from map(_AsmLine._make, asmlines)
 
     def _trace_for_coverage(self):
+        program_id = self._program['id']
+        if self._args.b:
+            sql = _SQL_SELECT_UNCOVERED
+        else:
+            sql = _SQL_SELECT_INSTRUCTIONS
+        addrs = array.array(
+            'Q',
+            (addr for addr, in self._db.execute(sql, (program_id,)))
+        )
+        counts = array.array('Q', [0]) * len(addrs)
         pid = self._ptrace.asmcovtrace_open(
             self._args.file.encode(),
             self._argv
         )
-        while True:
-            rip = self._ptrace.asmcovtrace_next(pid)
-            if rip <= 256:
-                self.exit_code = rip
-                break
-            self._db.execute(
-                '''UPDATE line SET hits = hits + 1
-                WHERE program_id = ?
-                AND type = "instruction"
-                AND line_number = ?''',
-                (self._program['id'], rip)
+        try:
+            if self._args.b:
+                self.exit_code = self._ptrace.asmcovtrace_run_breakpoints(
+                    pid,
+                    addrs,
+                    counts
+                )
+            else:
+                self.exit_code = self._ptrace.asmcovtrace_run(
+                    pid,
+                    addrs,
+                    counts
+                )
+        finally:
+            # keep the hits collected so far even if the trace was interrupted
+            self._db.execute('BEGIN IMMEDIATE')
+            self._db.executemany(
+                _SQL_UPDATE_HITS,
+                [
+                    (count, program_id, addr)
+                    for addr, count in zip(addrs, counts)
+                    if count > 0
+                ]
             )
-        self._db.commit()
+            self._db.execute('COMMIT')
+        if self.exit_code == _ASMCOVTRACE_INTERRUPTED:
+            raise KeyboardInterrupt
 
 
 def _main():
@@ -289,6 +437,12 @@ def _main():
         action='store_true',
         help='generate and display report'
     )
+    parser.add_argument(
+        '-b',
+        action='store_true',
+        help='only record the first hit of uncovered instructions (faster, '
+        'but patches .text, so do not use with data embedded in .text)'
+    )
     parser.add_argument(
         'file',
         help='binary to execute'
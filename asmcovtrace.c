@@ -11,6 +11,9 @@
 #include <sys/wait.h>
 #include <err.h>
 #include <errno.h>
+#include <signal.h>
+#include <stddef.h>
+#include <stdlib.h>
 #include <unistd.h>
 
 pid_t
@@ -19,11 +22,142 @@ asmcovtrace_open(
 	char *const argv[]
 );
 
-unsigned long long
-asmcovtrace_next(
-	const pid_t pid
+int
+asmcovtrace_run(
+	const pid_t pid,
+	const unsigned long long *const addrs,
+	unsigned long long *const counts,
+	const size_t n
+);
+
+int
+asmcovtrace_run_breakpoints(
+	const pid_t pid,
+	const unsigned long long *const addrs,
+	unsigned long long *const counts,
+	const size_t n
 );
 
+/**
+ * Returned by asmcovtrace_run and asmcovtrace_run_breakpoints when a signal
+ * to the tracer, such as SIGINT, interrupted the trace.
+ */
+#define ASMCOVTRACE_INTERRUPTED -1
+
+/**
+ * Set by the SIGINT handler installed while tracing.
+ */
+static volatile sig_atomic_t g_interrupted;
+
+static void
+asmcovtrace_on_sigint(
+	const int sig
+){
+	(void)sig;
+	g_interrupted = 1;
+}
+
+/**
+ * Replace the caller's SIGINT handler while tracing. Python's own handler
+ * only sets a flag that is not looked at until the trace returns, and a
+ * SIGINT arriving outside waitpid would not interrupt anything. No
+ * SA_RESTART, so a blocked waitpid fails with EINTR.
+ */
+static void
+asmcovtrace_catch_sigint(
+	struct sigaction *const old
+){
+	struct sigaction sa;
+
+	g_interrupted = 0;
+	sa.sa_handler = asmcovtrace_on_sigint;
+	sa.sa_flags = 0;
+	sigemptyset(&sa.sa_mask);
+	if(sigaction(SIGINT, &sa, old) == -1){
+		err(1, "sigaction");
+	}
+}
+
+/**
+ * Restore the caller's SIGINT handler and hand it any SIGINT received
+ * while tracing, so Python raises KeyboardInterrupt as usual.
+ */
+static void
+asmcovtrace_release_sigint(
+	const struct sigaction *const old
+){
+	if(sigaction(SIGINT, old, NULL) == -1){
+		err(1, "sigaction");
+	}
+	if(g_interrupted){
+		raise(SIGINT);
+	}
+}
+
+/**
+ * Block in waitpid until a tracee changes state. Returns the thread ID
+ * that changed state, or -1 if SIGINT interrupted the trace so the
+ * caller can give control back to Python.
+ */
+static pid_t
+asmcovtrace_wait(
+	const pid_t pid,
+	int *const status
+){
+	pid_t tid;
+
+	if(g_interrupted){
+		return -1;
+	}
+	tid = waitpid(pid, status, __WALL);
+	if(tid == -1 && errno != EINTR){
+		err(1, "waitpid");
+	}
+	return tid;
+}
+
+/**
+ * Kill the traced process and the given tracees after an interrupted wait,
+ * then reap them so none is left stopped or half-patched.
+ */
+static void
+asmcovtrace_kill(
+	const pid_t pid,
+	const pid_t *const tids,
+	const size_t len
+){
+	size_t i;
+	int status;
+
+	kill(pid, SIGKILL);
+	for(i = 0; i < len; i++){
+		kill(tids[i], SIGKILL);
+	}
+	while(waitpid(-1, &status, __WALL) != -1 || errno == EINTR){
+	}
+}
+
+/**
+ * Convert a wait status for a terminated tracee into a shell-style exit
+ * code, using 128 + signal number for tracees killed by a signal.
+ */
+static int
+asmcovtrace_exit_code(
+	const int status
+){
+	if(WIFSIGNALED(status)){
+		return 128 + WTERMSIG(status);
+	}
+	return WEXITSTATUS(status);
+}
+
+/**
+ * Offset of RIP in the tracee's user area, so the instruction pointer can
+ * be read and written with a single-word PEEKUSER/POKEUSER instead of
+ * copying the whole register set.
+ */
+#define ASMCOVTRACE_RIP_OFFSET offsetof(struct user, regs.rip)
+
 pid_t
 asmcovtrace_open(
 	const char *const path,
@@ -45,24 +179,446 @@ asmcovtrace_open(
 	return pid;
 }
 
-unsigned long long
+/**
+ * Wait for the next single-step stop and step the tracee again. Signals
+ * sent to the tracee, such as SIGINT from the terminal, are delivered as
+ * it steps on. Returns 1 with the stopped instruction in rip, 0 with the
+ * exit code in rip once the tracee terminated, or ASMCOVTRACE_INTERRUPTED.
+ */
+static int
 asmcovtrace_next(
-	const pid_t pid
+	const pid_t pid,
+	unsigned long long *const rip
 ){
-	struct user_regs_struct regs;
 	int status;
 
-	wait(&status);
-	if(WIFEXITED(status)){
-		return WEXITSTATUS(status);
+	while(1){
+		if(asmcovtrace_wait(pid, &status) == -1){
+			return ASMCOVTRACE_INTERRUPTED;
+		}
+		if(WIFEXITED(status) || WIFSIGNALED(status)){
+			*rip = (unsigned long long)asmcovtrace_exit_code(status);
+			return 0;
+		}
+		if(WSTOPSIG(status) == SIGTRAP){
+			break;
+		}
+		if(ptrace(PTRACE_SINGLESTEP,
+		          pid,
+		          NULL,
+		          (void *)(long)WSTOPSIG(status)) == -1 &&
+		   errno != ESRCH){
+			err(1, "ptrace: %d", errno);
+		}
 	}
 	errno = 0;
-	if(ptrace(PTRACE_GETREGS, pid, NULL, &regs) == -1 ||
+	*rip = (unsigned long long)ptrace(
+		PTRACE_PEEKUSER,
+		pid,
+		(void *)ASMCOVTRACE_RIP_OFFSET,
+		NULL
+	);
+	if(errno != 0 ||
 	   ptrace(PTRACE_SINGLESTEP, pid, NULL, NULL) == -1){
 		if(errno == ESRCH){
+			*rip = 0;
 			return 0;
 		}
 		err(1, "ptrace: %d", errno);
 	}
-	return regs.rip;
+	return 1;
+}
+
+/**
+ * Find the index of an instruction address in the sorted address array,
+ * returning n if it is not one of the traced instructions.
+ */
+static size_t
+asmcovtrace_index(
+	const unsigned long long *const addrs,
+	const size_t n,
+	const unsigned long long addr
+){
+	size_t lo;
+	size_t hi;
+	size_t mid;
+
+	if(n == 0 || addr < addrs[0] || addr > addrs[n - 1]){
+		return n;
+	}
+	lo = 0;
+	hi = n;
+	while(lo < hi){
+		mid = lo + (hi - lo) / 2;
+		if(addrs[mid] < addr){
+			lo = mid + 1;
+		}
+		else{
+			hi = mid;
+		}
+	}
+	if(lo < n && addrs[lo] == addr){
+		return lo;
+	}
+	return n;
+}
+
+static int
+asmcovtrace_run_steps(
+	const pid_t pid,
+	const unsigned long long *const addrs,
+	unsigned long long *const counts,
+	const size_t n
+){
+	unsigned long long rip;
+	size_t i;
+	int rc;
+
+	while((rc = asmcovtrace_next(pid, &rip)) == 1){
+		i = asmcovtrace_index(addrs, n, rip);
+		if(i < n){
+			counts[i] += 1;
+		}
+	}
+	if(rc == ASMCOVTRACE_INTERRUPTED){
+		asmcovtrace_kill(pid, NULL, 0);
+		return ASMCOVTRACE_INTERRUPTED;
+	}
+	return (int)rip;
+}
+
+static void
+asmcovtrace_poke_byte(
+	const pid_t pid,
+	const unsigned long long addr,
+	const unsigned char byte,
+	unsigned char *const orig
+){
+	long word;
+
+	errno = 0;
+	word = ptrace(PTRACE_PEEKTEXT, pid, (void *)addr, NULL);
+	if(errno != 0){
+		err(1, "ptrace: %d", errno);
+	}
+	if(orig){
+		*orig = (unsigned char)(word & 0xff);
+	}
+	word = (long)(((unsigned long)word & ~0xffUL) | byte);
+	if(ptrace(PTRACE_POKETEXT, pid, (void *)addr, (void *)word) == -1){
+		err(1, "ptrace: %d", errno);
+	}
+}
+
+/**
+ * Growable list of thread IDs.
+ */
+struct asmcovtrace_tids{
+	pid_t *tids;
+	size_t len;
+	size_t cap;
+};
+
+static int
+asmcovtrace_tids_has(
+	const struct asmcovtrace_tids *const tids,
+	const pid_t tid
+){
+	size_t i;
+
+	for(i = 0; i < tids->len; i++){
+		if(tids->tids[i] == tid){
+			return 1;
+		}
+	}
+	return 0;
+}
+
+static void
+asmcovtrace_tids_add(
+	struct asmcovtrace_tids *const tids,
+	const pid_t tid
+){
+	pid_t *new_tids;
+
+	if(tids->len == tids->cap){
+		tids->cap = tids->cap ? tids->cap * 2 : 16;
+		new_tids = realloc(tids->tids, tids->cap * sizeof(*tids->tids));
+		if(new_tids == NULL){
+			err(1, "realloc");
+		}
+		tids->tids = new_tids;
+	}
+	tids->tids[tids->len] = tid;
+	tids->len += 1;
+}
+
+static int
+asmcovtrace_tids_remove(
+	struct asmcovtrace_tids *const tids,
+	const pid_t tid
+){
+	size_t i;
+
+	for(i = 0; i < tids->len; i++){
+		if(tids->tids[i] == tid){
+			tids->len -= 1;
+			tids->tids[i] = tids->tids[tids->len];
+			return 1;
+		}
+	}
+	return 0;
+}
+
+/**
+ * Resume a stopped tracee, delivering sig, or detach from it entirely.
+ * A tracee that was killed in the meantime is ignored.
+ */
+static void
+asmcovtrace_resume(
+	const pid_t tid,
+	const int sig,
+	const int detach
+){
+	enum __ptrace_request request;
+
+	request = detach ? PTRACE_DETACH : PTRACE_CONT;
+	if(ptrace(request, tid, NULL, (void *)(long)sig) == -1 &&
+	   errno != ESRCH){
+		err(1, "ptrace: %d", errno);
+	}
+}
+
+/**
+ * Handle the first stop of a tracee created by fork, vfork or clone.
+ * Forked children have their own copy of the text with every unhit
+ * breakpoint still armed, so those are removed before detaching. vfork
+ * children and threads share memory with the parent and stay traced so
+ * their breakpoint hits are handled like any other, unless detach is set
+ * because no breakpoint is left.
+ */
+static void
+asmcovtrace_new_tracee(
+	struct asmcovtrace_tids *const tracees,
+	struct asmcovtrace_tids *const pending,
+	const pid_t child,
+	const int event,
+	const unsigned long long *const addrs,
+	const unsigned long long *const counts,
+	const unsigned char *const orig,
+	const size_t n,
+	const int detach
+){
+	size_t i;
+	int status;
+
+	if(!asmcovtrace_tids_remove(pending, child)){
+		/* the child's first stop is imminent, so retry if interrupted */
+		while(asmcovtrace_wait(child, &status) == -1){
+		}
+		if(!WIFSTOPPED(status)){
+			return;
+		}
+	}
+	if(event == PTRACE_EVENT_FORK){
+		for(i = 0; i < n; i++){
+			if(counts[i] == 0){
+				asmcovtrace_poke_byte(child, addrs[i], orig[i], NULL);
+			}
+		}
+		asmcovtrace_resume(child, 0, 1);
+	}
+	else if(detach){
+		asmcovtrace_resume(child, 0, 1);
+	}
+	else{
+		asmcovtrace_tids_add(tracees, child);
+		asmcovtrace_resume(child, 0, 0);
+	}
+}
+
+static int
+asmcovtrace_run_traps(
+	const pid_t pid,
+	const unsigned long long *const addrs,
+	unsigned long long *const counts,
+	const size_t n
+){
+	struct asmcovtrace_tids tracees = {NULL, 0, 0};
+	struct asmcovtrace_tids pending = {NULL, 0, 0};
+	unsigned long long rip;
+	unsigned long msg;
+	unsigned char *orig;
+	size_t remaining;
+	size_t i;
+	pid_t tid;
+	int status;
+	int event;
+	int sig;
+
+	if(asmcovtrace_wait(pid, &status) == -1){
+		asmcovtrace_kill(pid, NULL, 0);
+		return ASMCOVTRACE_INTERRUPTED;
+	}
+	if(!WIFSTOPPED(status)){
+		return asmcovtrace_exit_code(status);
+	}
+	if(ptrace(PTRACE_SETOPTIONS, pid, NULL,
+	          (void *)(PTRACE_O_TRACEFORK |
+	                   PTRACE_O_TRACEVFORK |
+	                   PTRACE_O_TRACECLONE |
+	                   PTRACE_O_TRACEEXEC)) == -1){
+		err(1, "ptrace: %d", errno);
+	}
+	orig = calloc(n ? n : 1, sizeof(*orig));
+	if(orig == NULL){
+		err(1, "calloc");
+	}
+	for(i = 0; i < n; i++){
+		asmcovtrace_poke_byte(pid, addrs[i], 0xcc, &orig[i]);
+	}
+	remaining = n;
+	asmcovtrace_tids_add(&tracees, pid);
+	asmcovtrace_resume(pid, 0, remaining == 0);
+	while(1){
+		tid = asmcovtrace_wait(-1, &status);
+		if(tid == -1){
+			/*
+			 * Killing the tracees is the only cleanup that also covers
+			 * threads currently running in patched text.
+			 */
+			for(i = 0; i < pending.len; i++){
+				kill(pending.tids[i], SIGKILL);
+			}
+			asmcovtrace_kill(pid, tracees.tids, tracees.len);
+			status = ASMCOVTRACE_INTERRUPTED;
+			break;
+		}
+		if(!WIFSTOPPED(status)){
+			if(tid == pid){
+				status = asmcovtrace_exit_code(status);
+				break;
+			}
+			asmcovtrace_tids_remove(&tracees, tid);
+			continue;
+		}
+		if(!asmcovtrace_tids_has(&tracees, tid)){
+			/*
+			 * First stop of a new child or thread, reported before the
+			 * parent's fork/clone event. Leave it stopped until then.
+			 */
+			asmcovtrace_tids_add(&pending, tid);
+			continue;
+		}
+		sig = WSTOPSIG(status);
+		event = status >> 16;
+		if(event == PTRACE_EVENT_FORK ||
+		   event == PTRACE_EVENT_VFORK ||
+		   event == PTRACE_EVENT_CLONE){
+			if(ptrace(PTRACE_GETEVENTMSG, tid, NULL, &msg) == -1){
+				err(1, "ptrace: %d", errno);
+			}
+			asmcovtrace_new_tracee(
+				&tracees,
+				&pending,
+				(pid_t)msg,
+				event,
+				addrs,
+				counts,
+				orig,
+				n,
+				remaining == 0
+			);
+			sig = 0;
+		}
+		else if(event == PTRACE_EVENT_EXEC){
+			/* the new program image has none of the breakpoints */
+			asmcovtrace_tids_remove(&tracees, tid);
+			asmcovtrace_resume(tid, 0, 1);
+			continue;
+		}
+		else if(event != 0){
+			sig = 0;
+		}
+		else if(sig == SIGTRAP){
+			errno = 0;
+			rip = (unsigned long long)ptrace(
+				PTRACE_PEEKUSER,
+				tid,
+				(void *)ASMCOVTRACE_RIP_OFFSET,
+				NULL
+			);
+			if(errno != 0){
+				err(1, "ptrace: %d", errno);
+			}
+			i = asmcovtrace_index(addrs, n, rip - 1);
+			/*
+			 * A hit breakpoint is restored before the tracee resumes, but
+			 * another thread may have trapped on it in the meantime. Only
+			 * an original INT3 in the program is a real SIGTRAP.
+			 */
+			if(i < n && (counts[i] == 0 || orig[i] != 0xcc)){
+				if(counts[i] == 0){
+					counts[i] = 1;
+					remaining -= 1;
+					asmcovtrace_poke_byte(tid, addrs[i], orig[i], NULL);
+				}
+				if(ptrace(PTRACE_POKEUSER,
+				          tid,
+				          (void *)ASMCOVTRACE_RIP_OFFSET,
+				          (void *)addrs[i]) == -1){
+					err(1, "ptrace: %d", errno);
+				}
+				sig = 0;
+			}
+		}
+		if(remaining == 0){
+			/*
+			 * Nothing left that could trap, so stop tracing each tracee
+			 * at its next stop and let it run without any further stops.
+			 * The leader's exit status is still reported to waitpid.
+			 */
+			asmcovtrace_tids_remove(&tracees, tid);
+			asmcovtrace_resume(tid, sig, 1);
+		}
+		else{
+			asmcovtrace_resume(tid, sig, 0);
+		}
+	}
+	free(pending.tids);
+	free(tracees.tids);
+	free(orig);
+	return status;
+}
+
+int
+asmcovtrace_run(
+	const pid_t pid,
+	const unsigned long long *const addrs,
+	unsigned long long *const counts,
+	const size_t n
+){
+	struct sigaction old;
+	int rc;
+
+	asmcovtrace_catch_sigint(&old);
+	rc = asmcovtrace_run_steps(pid, addrs, counts, n);
+	asmcovtrace_release_sigint(&old);
+	return rc;
+}
+
+int
+asmcovtrace_run_breakpoints(
+	const pid_t pid,
+	const unsigned long long *const addrs,
+	unsigned long long *const counts,
+	const size_t n
+){
+	struct sigaction old;
+	int rc;
+
+	asmcovtrace_catch_sigint(&old);
+	rc = asmcovtrace_run_traps(pid, addrs, counts, n);
+	asmcovtrace_release_sigint(&old);
+	return rc;
 }